@@ -12,17 +12,25 @@ if not IN_CONTAINER:
 class Env:
     IN_CONTAINER = IN_CONTAINER
     LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+    PROFILING = False if os.getenv("PROFILING", "false").lower() == "false" else True
+    PROFILING_MAX_CYCLES = int(os.getenv("PROFILING_MAX_CYCLES", "20"))
     VERIFY_SSL_CERTS = False if os.getenv("VERIFY_SSL_CERTS", "false").lower() == "false" else True
 
     IMAGE_DIR = os.path.join(os.getcwd(), "images") if not IN_CONTAINER else "/images"
     CONFIG_DIR = os.path.join(os.getcwd(), "config") if not IN_CONTAINER else "/config"
+    PROFILING_DIR = os.path.join(CONFIG_DIR, "profiling")
 
     DRY_RUN = False if os.getenv("DRY_RUN", "false").lower() == "false" else True
     MEURAL_USERNAME = os.getenv("MEURAL_USERNAME", None)
     MEURAL_PASSWORD = os.getenv("MEURAL_PASSWORD", None)
     UPDATE_FREQUENCY_MINS = os.getenv("UPDATE_FREQUENCY_MINS", None)
+    CONTROL_PORT = os.getenv("CONTROL_PORT", None)
+    CONTROL_HOST = os.getenv("CONTROL_HOST", "0.0.0.0" if IN_CONTAINER else "127.0.0.1")
+
+    CONFIG_POLL_INTERVAL_SECS = 15
 
     DELETE_FROM_ICLOUD_PLAYLIST_NAME = "Delete From iCloud"
+    DEFAULT_MEURAL_ACCOUNT_NAME = "default"
 
     @classmethod
     def validate_environment(cls):
@@ -32,8 +40,8 @@ class Env:
             if not os.path.isdir(directory):
                 raise ValueError(f"{directory} directory was not found")
 
-        # Second check env vars
-        env_vars = [cls.MEURAL_USERNAME, cls.MEURAL_PASSWORD, cls.UPDATE_FREQUENCY_MINS]
+        # Second check env vars. Meural credentials are optional when accounts are defined in config.yaml
+        env_vars = [cls.UPDATE_FREQUENCY_MINS]
         for env_var in env_vars:
             if env_var is None:
                 name_as_str = f'{env_var=}'.split('=')[0]
@@ -0,0 +1,105 @@
+from configuration import logger
+from models import UserConfiguration
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import json
+import os
+import threading
+
+class ConfigWatcher:
+    def __init__(self, user_configuration, destinations, build_destinations, validate_sync_task):
+        self.user_configuration = user_configuration
+        self.destinations = destinations
+        # Called with a reloaded config & the current destinations, and returns the destinations for the reloaded config
+        self.build_destinations = build_destinations
+        # Called with each sync task of a reloaded config, and should raise ValueError if it cannot be synced
+        self.validate_sync_task = validate_sync_task
+        self._last_mtime = self._get_mtime()
+
+    def _get_mtime(self):
+        try:
+            return os.path.getmtime(self.user_configuration.config_location)
+        except OSError:
+            return None
+
+    def reload_if_changed(self):
+        """Reloads config.yaml if it has been modified, returning the sync tasks which were added or changed.
+        If the new config is invalid, it is rejected and the currently loaded config stays in use."""
+        mtime = self._get_mtime()
+        if mtime is None or mtime == self._last_mtime:
+            return []
+        self._last_mtime = mtime
+        logger.info("[*] Configuration file has changed - reloading it")
+
+        try:
+            new_configuration = UserConfiguration(self.user_configuration.config_location)
+            new_destinations = self.build_destinations(new_configuration, self.destinations)
+            for sync_task in new_configuration.sync_tasks:
+                # Accounts which could not be connected to are retried later, rather than rejecting the whole config
+                if sync_task.meural_account in new_destinations:
+                    self.validate_sync_task(sync_task, new_destinations)
+        except Exception as e:
+            logger.error(f"\tThe updated configuration is invalid and was not applied: {e}")
+            return []
+
+        old_tasks_by_key = {(sync_task.meural_account, sync_task.icloud_album): sync_task for sync_task in self.user_configuration.sync_tasks}
+        new_tasks_by_key = {(sync_task.meural_account, sync_task.icloud_album): sync_task for sync_task in new_configuration.sync_tasks}
+        tasks_to_sync = []
+        for (meural_account, icloud_album), sync_task in new_tasks_by_key.items():
+            old_sync_task = old_tasks_by_key.get((meural_account, icloud_album))
+            if old_sync_task is None:
+                logger.info(f"\tAdded sync task for {icloud_album} in the {meural_account} Meural account")
+                tasks_to_sync.append(sync_task)
+            elif sync_task != old_sync_task or self.destinations.get(meural_account) is not new_destinations.get(meural_account):
+                logger.info(f"\tChanged sync task for {icloud_album} in the {meural_account} Meural account")
+                tasks_to_sync.append(sync_task)
+        for (meural_account, icloud_album) in old_tasks_by_key:
+            if (meural_account, icloud_album) not in new_tasks_by_key:
+                logger.info(f"\tRemoved sync task for {icloud_album} in the {meural_account} Meural account")
+
+        # Only now that the config is known to be valid do reused destinations pick up their updated account settings
+        for meural_account, destination in new_destinations.items():
+            destination.meural_account = new_configuration.meural_accounts[meural_account]
+        self.user_configuration = new_configuration
+        self.destinations = new_destinations
+        logger.info("\tUpdated configuration applied")
+        return tasks_to_sync
+
+
+class ControlServer:
+    def __init__(self, host, port, sync_callback):
+        # sync_callback is called with an iCloud album id/url (or None for all albums), and returns (http_status, result)
+        self.sync_callback = sync_callback
+        self.httpd = ThreadingHTTPServer((host, int(port)), self._build_handler())
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def start(self):
+        logger.info(f"Control endpoint listening on http://{self.httpd.server_address[0]}:{self.httpd.server_address[1]}")
+        self.thread.start()
+
+    def _build_handler(self):
+        sync_callback = self.sync_callback
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                parsed_url = urlparse(self.path)
+                if parsed_url.path != "/sync":
+                    self._respond(404, {"error": f"Unknown endpoint {parsed_url.path}"})
+                    return
+                album = parse_qs(parsed_url.query).get("album", [None])[0]
+                logger.info(f"[*] On-demand sync requested for {album if album else 'all albums'}")
+                status, result = sync_callback(album)
+                self._respond(status, result)
+
+            def _respond(self, status, body):
+                payload = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                logger.debug(f"\tControl endpoint: {format % args}")
+
+        return Handler
@@ -1,4 +1,5 @@
 from configuration import Env, logger
+from profiling import Profiler
 import json
 import os
 import requests
@@ -6,23 +7,22 @@ import requests
 if Env.VERIFY_SSL_CERTS is False:
     requests.packages.urllib3.disable_warnings(requests.packages.urllib3.exceptions.InsecureRequestWarning)
 
+@Profiler.trace("icloud.post_json")
 def post_json(url, data):
     response = requests.post(url, data=json.dumps(data), headers={'Content-Type': 'application/json'}, verify=Env.VERIFY_SSL_CERTS)
     return response.json()
 
 class iCloudAlbum:
     class Image:
-        def __init__(self, sync_task, meural_api, checksum, icloud_filename, url):
+        def __init__(self, checksum, icloud_filename, url):
             self.checksum = checksum
             self.icloud_filename = icloud_filename
             self.url = url
             self.image_binary = None  # Stores image binary after download
             self.paths_to_images_actually_downloaded = [] # Populated via self.download()
 
-            # Populated via self.populate_filenames(), formatted as {meural_playlist_name: filename}
-            self.save_as_filenames = self.populate_filenames(sync_task, meural_api)
-
         def populate_filenames(self, sync_task, meural_api):
+            # Filenames depend on the playlist ids of the Meural account being synced to, formatted as {meural_playlist_name: filename}
             filenames = {}
             original_extension = self.icloud_filename.rsplit('.', 1)[-1]
             for sync_to_playlist in sync_task.meural_playlists:
@@ -36,6 +36,7 @@ class iCloudAlbum:
                 filenames[sync_to_playlist.name] = filename
             return filenames
 
+        @Profiler.trace("icloud.download")
         def download(self, filename):
             absolute_path = f"{Env.IMAGE_DIR}/{filename}"
             logger.info(f"\tDownloading {filename}")
@@ -45,7 +46,9 @@ class iCloudAlbum:
                 with open(absolute_path, 'wb') as f:
                     f.write(self.image_binary)
                     logger.info(f"\t\t[✓] Saved to {absolute_path}")
-            self.paths_to_images_actually_downloaded.append(absolute_path)
+            # Several Meural accounts may save the image under the same filename
+            if absolute_path not in self.paths_to_images_actually_downloaded:
+                self.paths_to_images_actually_downloaded.append(absolute_path)
 
         def delete_downloaded_images(self):
             self.image_binary = None
@@ -57,18 +60,19 @@ class iCloudAlbum:
                     logger.info(f"\t\t[!] {absolute_path} does not exist, could not delete image. It may have not been downloaded")
             self.paths_to_images_actually_downloaded = []
 
-    def __init__(self, sync_task, meural_api):
+    def __init__(self, url):
         logger.info("Initializing iCloud Album API")
-        self.url = sync_task.icloud_album
+        self.url = url
         self.id = self.url.split('#')[1]
 
         # Populated by query_album()
         self.name = ""
         self.images_by_checksum = {}
-        self.query_album(sync_task, meural_api)
+        self.query_album()
         logger.info(f"\tIdentified {len(self.images_by_checksum)} images in the {self.name} iCloud album")
 
-    def query_album(self, sync_task, meural_api):
+    @Profiler.trace("icloud.query_album")
+    def query_album(self):
         logger.info(f"Retrieving iCloud album information ({self.url})")
         base_api_url = f"https://p23-sharedstreams.icloud.com/{self.id}/sharedstreams"
         stream_data = {"streamCtag": None}
@@ -95,10 +99,13 @@ class iCloudAlbum:
             for checksum in checksums:
                 if checksum in url:
                     self.images_by_checksum[checksum] = self.__class__.Image(
-                        sync_task=sync_task,
-                        meural_api=meural_api,
                         checksum=checksum,
                         icloud_filename=url.split('?')[0].split('/')[-1],
                         url=url
                     )
                     break
+
+    def delete_downloaded_images(self):
+        for icloud_image in self.images_by_checksum.values():
+            if icloud_image.paths_to_images_actually_downloaded:
+                icloud_image.delete_downloaded_images()
@@ -1,40 +1,184 @@
-import icloud, meural
+import icloud
 from configuration import Env, logger, halt_with_error
-from models import Metadata, UserConfiguration
+from control import ConfigWatcher, ControlServer
+from models import MeuralDestination, UserConfiguration
+from profiling import Profiler
+import threading
 import time
 import json
 import sys, traceback
 
-def scheduled_task(user_configuration, meural_api):
-    for sync_task in user_configuration.sync_tasks:
-        # Validate playlist has items
-        if len(sync_task.meural_playlists) == 0:
-            halt_with_error(f"Cannot sync {sync_task.icloud_album} because no Meural playlists were specified. Please update your configuration file.")
+# Held while a sync or config reload is in progress, so on-demand syncs never overlap with scheduled ones
+sync_lock = threading.Lock()
 
-        # Validate playlists that we will sync to exist
-        for sync_to_playlist in sync_task.meural_playlists:
-            if sync_to_playlist.name not in meural_api.playlist_ids_by_name:
-                halt_with_error(f"Cannot sync {sync_task.icloud_album} because {sync_to_playlist.name} Meural playlist does not exist. Please create it in Meural, or update your configuration file.")
+def scheduled_task(user_configuration, destinations):
+    # Retry any Meural accounts which could not be connected to previously
+    connect_missing_destinations(user_configuration, destinations)
+    return run_sync_tasks(user_configuration.sync_tasks, destinations)
 
-        # Instantiate the iCloud album object. This queries iCloud for the album's contents, which we'll download and sync one by one.
-        # All images will also have their expected filename per Meural playlist defined.
-        icloud_album_obj = icloud.iCloudAlbum(sync_task, meural_api)
+def run_sync_tasks(sync_tasks, destinations):
+    results = []
+    valid_sync_tasks = []
+    for sync_task in sync_tasks:
+        try:
+            validate_sync_task(sync_task, destinations)
+            valid_sync_tasks.append(sync_task)
+        except ValueError as e:
+            # Invalid tasks are skipped so the remaining tasks & Meural accounts keep syncing
+            logger.error(str(e))
+            results.append(_failed_sync_task_result(sync_task, e))
+    for icloud_album, album_sync_tasks in group_sync_tasks_by_icloud_album(valid_sync_tasks).items():
+        try:
+            results += sync_album(icloud_album, album_sync_tasks, destinations)
+        except Exception as e:
+            # e.g. iCloud being unreachable. Only this album is skipped, and it is retried on the next sync.
+            logger.error(f"Syncing the {icloud_album} iCloud album failed: {e}\n{traceback.format_exc()}")
+            results += [_failed_sync_task_result(sync_task, e) for sync_task in album_sync_tasks]
+    return results
 
-        # First delete items from Meural which no longer exist in iCloud. This automatically removes them from playlists too.
-        # Note: This will only delete items uploaded via this tool - other uploads will be skipped.
-        _subtask_delete_orphaned_images_from_meural(icloud_album_obj, meural_api)
+def _failed_sync_task_result(sync_task, error):
+    return {
+        "icloud_album": sync_task.icloud_album,
+        "meural_account": sync_task.meural_account,
+        "error": str(error)
+    }
 
-        # Now upload images which exist in iCloud but not in Meural, and add them to applicable playlists.
-        # This will also add uploaded images to new playlists should the configuration have updated.
-        _subtask_upload_new_images_to_meural(icloud_album_obj, meural_api)
+def validate_sync_task(sync_task, destinations):
+    if sync_task.meural_account not in destinations:
+        raise ValueError(f"Cannot sync {sync_task.icloud_album} because the {sync_task.meural_account} Meural account is not connected. Connecting will be retried on the next scheduled update")
+    meural_api = destinations[sync_task.meural_account].meural_api
+    # Validate playlist has items
+    if len(sync_task.meural_playlists) == 0:
+        raise ValueError(f"Cannot sync {sync_task.icloud_album} because no Meural playlists were specified. Please update your configuration file.")
 
-        # Finally, we want to mark images which have had all images deleted from Meural. To do so,
-        # we're going to add them to a "Delete From iCloud Album" playlist
-        _subtask_add_orphaned_images_to_remove_from_icloud_album(icloud_album_obj, meural_api)
-        return
+    # Validate playlists that we will sync to exist
+    for sync_to_playlist in sync_task.meural_playlists:
+        if sync_to_playlist.name not in meural_api.playlist_ids_by_name:
+            raise ValueError(f"Cannot sync {sync_task.icloud_album} because {sync_to_playlist.name} Meural playlist does not exist in the {sync_task.meural_account} Meural account. Please create it in Meural, or update your configuration file.")
 
-def _subtask_delete_orphaned_images_from_meural(icloud_album_obj, meural_api):
-    logger.info("[*] Determining if there are missing iCloud images that should be deleted from Meural")
+def connect_destination(meural_account):
+    logger.info(f"Connecting to the {meural_account.name} Meural account")
+    try:
+        return MeuralDestination(meural_account)
+    except Exception as e:
+        # A single unreachable account should not stop the other accounts from syncing
+        logger.error(f"Failed to connect to the {meural_account.name} Meural account: {e}\n{traceback.format_exc()}")
+        return None
+
+def connect_missing_destinations(user_configuration, destinations):
+    for meural_account in user_configuration.meural_accounts.values():
+        if meural_account.name not in destinations:
+            destination = connect_destination(meural_account)
+            if destination is not None:
+                destinations[meural_account.name] = destination
+
+def build_destinations(user_configuration, existing_destinations=None):
+    """Returns the destinations for user_configuration, reusing existing destinations where credentials are unchanged.
+    Existing destinations are not modified, so the result can be discarded if the configuration turns out to be invalid."""
+    existing_destinations = existing_destinations or {}
+    destinations = {}
+    for meural_account in user_configuration.meural_accounts.values():
+        existing_destination = existing_destinations.get(meural_account.name)
+        if existing_destination is not None and existing_destination.meural_account.has_same_credentials(meural_account):
+            # Reuse the existing session rather than logging in & pulling all Meural data again.
+            # Playlists may have been created in Meural to go along with a config change though.
+            try:
+                existing_destination.meural_api.refresh_playlist_data()
+                destinations[meural_account.name] = existing_destination
+            except Exception as e:
+                logger.error(f"Failed to refresh the {meural_account.name} Meural account: {e}\n{traceback.format_exc()}")
+        else:
+            destination = connect_destination(meural_account)
+            if destination is not None:
+                destinations[meural_account.name] = destination
+    return destinations
+
+def group_sync_tasks_by_icloud_album(sync_tasks):
+    # Several Meural accounts may sync the same iCloud album, which only needs to be queried & downloaded once
+    sync_tasks_by_icloud_album = {}
+    for sync_task in sync_tasks:
+        sync_tasks_by_icloud_album.setdefault(sync_task.icloud_album, []).append(sync_task)
+    return sync_tasks_by_icloud_album
+
+def _record_destination_failure(errors_by_account, icloud_album_obj, meural_account, error):
+    logger.error(f"Syncing the {icloud_album_obj.name} iCloud album to the {meural_account} Meural account failed: {error}\n{traceback.format_exc()}")
+    errors_by_account[meural_account] = str(error)
+
+@Profiler.trace("sync_album")
+def sync_album(icloud_album, sync_tasks, destinations):
+    # Instantiate the iCloud album object. This queries iCloud for the album's contents, which we'll download and sync one by one.
+    icloud_album_obj = icloud.iCloudAlbum(icloud_album)
+
+    # A failure in one Meural account skips the rest of the album for that account only, and is reported in its result
+    errors_by_account = {}
+
+    # First delete items from Meural which no longer exist in iCloud. This automatically removes them from playlists too.
+    # Note: This will only delete items uploaded via this tool - other uploads will be skipped.
+    num_images_deleted_by_account = {}
+    for sync_task in sync_tasks:
+        destination = destinations[sync_task.meural_account]
+        try:
+            num_images_deleted_by_account[destination.name] = _subtask_delete_orphaned_images_from_meural(icloud_album_obj, destination)
+        except Exception as e:
+            _record_destination_failure(errors_by_account, icloud_album_obj, destination.name, e)
+
+    # Now upload images which exist in iCloud but not in Meural, and add them to applicable playlists.
+    # This will also add uploaded images to new playlists should the configuration have updated.
+    # Each image is downloaded once and uploaded to every Meural account syncing this album.
+    num_images_added_by_account = _subtask_upload_new_images_to_meural(icloud_album_obj, sync_tasks, destinations, errors_by_account)
+
+    # Finally, we want to mark images which have had all images deleted from Meural. To do so,
+    # we're going to add them to a "Delete From iCloud Album" playlist
+    num_images_orphaned_by_account = {}
+    for sync_task in sync_tasks:
+        if sync_task.meural_account in errors_by_account:
+            continue
+        destination = destinations[sync_task.meural_account]
+        try:
+            num_images_orphaned_by_account[destination.name] = _subtask_add_orphaned_images_to_remove_from_icloud_album(icloud_album_obj, destination)
+        except Exception as e:
+            _record_destination_failure(errors_by_account, icloud_album_obj, destination.name, e)
+
+    # All accounts are done with this album, so delete anything still downloaded from the filesystem
+    if not Env.DRY_RUN:
+        icloud_album_obj.delete_downloaded_images()
+
+    results = []
+    for sync_task in sync_tasks:
+        result = {
+            "icloud_album": icloud_album,
+            "name": icloud_album_obj.name,
+            "meural_account": sync_task.meural_account,
+            "images_deleted_from_meural": num_images_deleted_by_account.get(sync_task.meural_account, 0),
+            "images_uploaded_to_meural": num_images_added_by_account.get(sync_task.meural_account, 0),
+            "images_marked_for_icloud_deletion": num_images_orphaned_by_account.get(sync_task.meural_account, 0)
+        }
+        if sync_task.meural_account in errors_by_account:
+            result["error"] = errors_by_account[sync_task.meural_account]
+        results.append(result)
+    return results
+
+def on_demand_sync(config_watcher, album=None):
+    with sync_lock:
+        sync_tasks = config_watcher.user_configuration.sync_tasks
+        if album is not None:
+            # Albums can be referenced by their full shared url, or just the id following the '#'
+            sync_tasks = [sync_task for sync_task in sync_tasks if album in (sync_task.icloud_album, sync_task.icloud_album.split('#')[-1])]
+            if not sync_tasks:
+                return 404, {"error": f"{album} is not a configured iCloud album"}
+        with Profiler.cycle("on_demand_sync"):
+            try:
+                # Failures within a single Meural account are reported in that account's result
+                results = run_sync_tasks(sync_tasks, config_watcher.destinations)
+            except Exception as e:
+                logger.error(f"On-demand sync failed: {e}\n{traceback.format_exc()}")
+                return 500, {"error": str(e)}
+        return 200, {"results": results}
+
+@Profiler.trace("subtask.delete_orphaned_images_from_meural")
+def _subtask_delete_orphaned_images_from_meural(icloud_album_obj, destination):
+    logger.info(f"[*] Determining if there are missing iCloud images that should be deleted from the {destination.name} Meural account")
+    meural_api = destination.meural_api
     num_images_deleted = 0
     if icloud_album_obj.id in meural_api.uploaded_images_by_icloud_album_id:
         for meural_image_data in meural_api.uploaded_images_by_icloud_album_id[icloud_album_obj.id]:
@@ -43,7 +187,7 @@ def _subtask_delete_orphaned_images_from_meural(icloud_album_obj, meural_api):
                 logger.info(f"\tDeleting orphaned image {meural_image_data['name']} in Meural - it no longer exists in the {icloud_album_obj.name} iCloud album")
                 if not Env.DRY_RUN:
                     meural_api.delete_image(meural_image_data['id'])
-                    Metadata.mark_image_deleted_from_meural(icloud_album_obj.id, meural_image_data['name'])
+                    destination.metadata.mark_image_deleted_from_meural(icloud_album_obj.id, meural_image_data['name'])
                 else:
                     logger.info(f"\t[DRY RUN]: Would have deleted {meural_image_data['name']} from Meural")
                 num_images_deleted += 1
@@ -57,61 +201,76 @@ def _subtask_delete_orphaned_images_from_meural(icloud_album_obj, meural_api):
         meural_api.refresh_uploaded_image_data()
     else:
         logger.info("\tThere are no images which need to be deleted from Meural")
-    return
+    return num_images_deleted
 
-def _subtask_upload_new_images_to_meural(icloud_album_obj, meural_api):
+@Profiler.trace("subtask.upload_new_images_to_meural")
+def _subtask_upload_new_images_to_meural(icloud_album_obj, sync_tasks, destinations, errors_by_account):
     logger.info("[*] Determining if there are added iCloud images that should be uploaded to Meural")
-    num_images_added = 0
-    # Iterate through the images in the album. We're going to download them, and then add them to the associated meural playlists.
+    num_images_added_by_account = {sync_task.meural_account: 0 for sync_task in sync_tasks}
+    # Iterate through the images in the album. We're going to download them, and then add them to the associated meural playlists of every account.
     for icloud_image in icloud_album_obj.images_by_checksum.values():
-        this_image_was_uploaded = False
-        for meural_playlist_name, save_filename in icloud_image.save_as_filenames.items():
-            meural_filename = save_filename.rsplit('.', 1)[0]
-            meural_playlist_id = meural_api.playlist_ids_by_name[meural_playlist_name]
-            if meural_filename not in meural_api.uploaded_filenames_by_icloud_album_id[icloud_album_obj.id]:
-                if meural_filename not in Metadata.db[icloud_album_obj.id]:
-                    if not Env.DRY_RUN:
-                        icloud_image.download(save_filename)  # Only downloads once per image - if already downloaded, this just makes another file to avoid Meural dedupe
-                        # Upload the image & get the meural id
-                        image_id = meural_api.upload_image(save_filename)
-                        # Update the image metadata in meural. If "_" is in the filename, it means that there was an associated playlist. Otherwise, the image is non-unique.
-                        metadata_playlist = meural_playlist_name if "_" in meural_filename else None
-                        metadata = {
-                            "description": f'{{"icloud_album_id": "{icloud_album_obj.id}", "checksum": "{icloud_image.checksum}", "playlist_name": "{metadata_playlist}"}}'
-                        }
-                        meural_api.update_image_metadata(image_id, metadata)
-                        # Finally, add it to the playlist and verify it's actually been added
-                        image_ids_in_playlist = meural_api.add_image_to_playlist(image_id, meural_playlist_id)
-                        if image_id not in image_ids_in_playlist:
-                            halt_with_error(f"Failed to add image {image_id} to playlist {meural_playlist_name}")
-                        Metadata.mark_image_added_to_playlist(icloud_album_obj.id, meural_filename)
-                        logger.info(f"\tUploaded {save_filename} to {meural_playlist_name}")
-                    else:
-                        logger.info(f"[DRY RUN]: Would have uploaded {save_filename} to {meural_playlist_name}")
-                        meural_api.dry_run_added_checksums.append(icloud_image.checksum)
-                    this_image_was_uploaded = True
-                else:
-                    logger.debug(f"{meural_filename} was previously uploaded to Meural, but has since been deleted")
-        if this_image_was_uploaded:
-            num_images_added += 1
-
-            # All work is done for this image, so delete it from the filesystem
-            if not Env.DRY_RUN:
-                logger.info(f"\tDeleting temporary images from local filesystem")
-                icloud_image.delete_downloaded_images()
+        for sync_task in sync_tasks:
+            if sync_task.meural_account in errors_by_account:
+                continue
+            destination = destinations[sync_task.meural_account]
+            meural_api = destination.meural_api
+            this_image_was_uploaded = False
+            try:
+                for meural_playlist_name, save_filename in icloud_image.populate_filenames(sync_task, meural_api).items():
+                    meural_filename = save_filename.rsplit('.', 1)[0]
+                    meural_playlist_id = meural_api.playlist_ids_by_name[meural_playlist_name]
+                    if meural_filename not in meural_api.uploaded_filenames_by_icloud_album_id.get(icloud_album_obj.id, []):
+                        if meural_filename not in destination.metadata.db.get(icloud_album_obj.id, []):
+                            if not Env.DRY_RUN:
+                                icloud_image.download(save_filename)  # Only downloads once per image - if already downloaded, this just makes another file to avoid Meural dedupe
+                                # Upload the image & get the meural id
+                                image_id = meural_api.upload_image(save_filename)
+                                # Update the image metadata in meural. If "_" is in the filename, it means that there was an associated playlist. Otherwise, the image is non-unique.
+                                metadata_playlist = meural_playlist_name if "_" in meural_filename else None
+                                metadata = {
+                                    "description": f'{{"icloud_album_id": "{icloud_album_obj.id}", "checksum": "{icloud_image.checksum}", "playlist_name": "{metadata_playlist}"}}'
+                                }
+                                meural_api.update_image_metadata(image_id, metadata)
+                                # Finally, add it to the playlist and verify it's actually been added
+                                image_ids_in_playlist = meural_api.add_image_to_playlist(image_id, meural_playlist_id)
+                                if image_id not in image_ids_in_playlist:
+                                    raise RuntimeError(f"Failed to add image {image_id} to playlist {meural_playlist_name} in the {destination.name} Meural account")
+                                destination.metadata.mark_image_added_to_playlist(icloud_album_obj.id, meural_filename)
+                                logger.info(f"\tUploaded {save_filename} to {meural_playlist_name} in the {destination.name} Meural account")
+                            else:
+                                logger.info(f"[DRY RUN]: Would have uploaded {save_filename} to {meural_playlist_name} in the {destination.name} Meural account")
+                                meural_api.dry_run_added_checksums.append(icloud_image.checksum)
+                            this_image_was_uploaded = True
+                        else:
+                            logger.debug(f"{meural_filename} was previously uploaded to the {destination.name} Meural account, but has since been deleted")
+            except Exception as e:
+                _record_destination_failure(errors_by_account, icloud_album_obj, destination.name, e)
+                continue
+            if this_image_was_uploaded:
+                num_images_added_by_account[destination.name] += 1
 
+        # All work is done for this image in every account, so delete it from the filesystem
+        if icloud_image.paths_to_images_actually_downloaded:
+            logger.info(f"\tDeleting temporary images from local filesystem")
+            icloud_image.delete_downloaded_images()
 
     # If an image has been added, refresh uploaded meural information
-    if num_images_added > 0:
-        logger.info(f"{num_images_added} images were uploaded to Meural")
-        meural_api.refresh_playlist_data()
-        meural_api.refresh_uploaded_image_data()
-    else:
-        logger.info("\tThere are no images which need to be uploaded to Meural")
-    return
+    for meural_account, num_images_added in num_images_added_by_account.items():
+        if num_images_added > 0:
+            logger.info(f"{num_images_added} images were uploaded to the {meural_account} Meural account")
+            try:
+                destinations[meural_account].meural_api.refresh_playlist_data()
+                destinations[meural_account].meural_api.refresh_uploaded_image_data()
+            except Exception as e:
+                _record_destination_failure(errors_by_account, icloud_album_obj, meural_account, e)
+        elif meural_account not in errors_by_account:
+            logger.info(f"\tThere are no images which need to be uploaded to the {meural_account} Meural account")
+    return num_images_added_by_account
 
-def _subtask_add_orphaned_images_to_remove_from_icloud_album(icloud_album_obj, meural_api):
-    logger.info("[*] Determining if there are new missing Meural images that should be marked for deletion from iCloud")
+@Profiler.trace("subtask.add_orphaned_images_to_remove_from_icloud_album")
+def _subtask_add_orphaned_images_to_remove_from_icloud_album(icloud_album_obj, destination):
+    logger.info(f"[*] Determining if there are new missing images in the {destination.name} Meural account that should be marked for deletion from iCloud")
+    meural_api = destination.meural_api
     orphaned_icloud_images = []
     for checksum, icloud_image in icloud_album_obj.images_by_checksum.items():
         # If dry run, check if the checksum is in the dry run added names first
@@ -164,13 +323,13 @@ def _subtask_add_orphaned_images_to_remove_from_icloud_album(icloud_album_obj, m
                 meural_api.update_image_metadata(image_id, metadata)
                 image_ids_in_playlist = meural_api.add_image_to_playlist(image_id, orphaned_album_id)
                 if image_id not in image_ids_in_playlist:
-                    halt_with_error(f"Failed to add image {image_id} to playlist {Env.DELETE_FROM_ICLOUD_PLAYLIST_NAME}")
+                    raise RuntimeError(f"Failed to add image {image_id} to playlist {Env.DELETE_FROM_ICLOUD_PLAYLIST_NAME} in the {destination.name} Meural account")
                 logger.info(f"\tUploaded {save_filename} to {Env.DELETE_FROM_ICLOUD_PLAYLIST_NAME}")
             else:
                 logger.info(f"\t[DRY RUN]: Would have added orphaned {orphaned_icloud_image.icloud_filename} to {Env.DELETE_FROM_ICLOUD_PLAYLIST_NAME} Meural playlist")
     else:
         logger.info("\tThere are no images which need to be deleted from iCloud")
-    return
+    return len(orphaned_icloud_images)
 
 
 if __name__ == "__main__":
@@ -179,18 +338,34 @@ if __name__ == "__main__":
         logger.warning("Dry Run mode enabled!")
     try:
         Env.validate_environment()
-        Metadata.initialize()
 
         user_configuration = UserConfiguration()
-        meural_api = meural.MeuralAPI(
-            username=Env.MEURAL_USERNAME,
-            password=Env.MEURAL_PASSWORD
-        )
+        with Profiler.cycle("startup"):
+            destinations = build_destinations(user_configuration)
+        config_watcher = ConfigWatcher(user_configuration, destinations, build_destinations, validate_sync_task)
+
+        if Env.CONTROL_PORT:
+            ControlServer(
+                host=Env.CONTROL_HOST,
+                port=Env.CONTROL_PORT,
+                sync_callback=lambda album: on_demand_sync(config_watcher, album)
+            ).start()
 
+        next_update_at = time.monotonic()
         while True:
-            logger.info("============================== Starting scheduled update ==============================")
-            scheduled_task(user_configuration, meural_api)
-            logger.info(f"Done! Pausing for {Env.UPDATE_FREQUENCY_MINS} minutes until next update...")
-            time.sleep(int(Env.UPDATE_FREQUENCY_MINS)*60)
+            if time.monotonic() >= next_update_at:
+                logger.info("============================== Starting scheduled update ==============================")
+                with sync_lock, Profiler.cycle("scheduled_update"):
+                    scheduled_task(config_watcher.user_configuration, config_watcher.destinations)
+                logger.info(f"Done! Pausing for {Env.UPDATE_FREQUENCY_MINS} minutes until next update...")
+                next_update_at = time.monotonic() + int(Env.UPDATE_FREQUENCY_MINS)*60
+
+            # Wake up periodically to pick up config changes, and immediately sync any added or changed albums
+            time.sleep(max(0, min(Env.CONFIG_POLL_INTERVAL_SECS, next_update_at - time.monotonic())))
+            with sync_lock:
+                sync_tasks = config_watcher.reload_if_changed()
+                if sync_tasks:
+                    with Profiler.cycle("config_reload_sync"):
+                        run_sync_tasks(sync_tasks, config_watcher.destinations)
     except Exception as e:
         halt_with_error(f"Fatal error occurred: {e}\n{traceback.format_exc()}")
@@ -1,4 +1,5 @@
 from configuration import Env, logger
+from profiling import Profiler
 import requests
 import json
 
@@ -32,6 +33,7 @@ class MeuralAPI:
         self.dry_run_added_checksums = []
 
 
+    @Profiler.trace("meural.get_authentication_token")
     def get_authentication_token(self, username, password):
         url = f"{URL_BASE}/authenticate"
         data = {
@@ -58,7 +60,8 @@ class MeuralAPI:
         while is_last_page is False:
             pagination_url = f"{url}&page={page_to_request}"
             logger.debug(f"\t\tRequesting data from {pagination_url}")
-            response = self.session.get(pagination_url, headers=self.headers, allow_redirects=True, timeout=15, verify=Env.VERIFY_SSL_CERTS)
+            with Profiler.span("meural.get_page"):
+                response = self.session.get(pagination_url, headers=self.headers, allow_redirects=True, timeout=15, verify=Env.VERIFY_SSL_CERTS)
             response_json = None
             try:
                 response_json = response.json()
@@ -79,6 +82,7 @@ class MeuralAPI:
                 break
         return return_data
 
+    @Profiler.trace("meural.refresh_playlist_data")
     def refresh_playlist_data(self):
         logger.info("\tRefreshing Meural playlist data")
         url = f"{URL_BASE}/user/galleries?count=500"
@@ -87,6 +91,7 @@ class MeuralAPI:
         self.uploaded_image_ids_by_playlist_name = {playlist['name']: playlist['itemIds'] for playlist in all_data_as_dict}
         return
 
+    @Profiler.trace("meural.refresh_uploaded_image_data")
     def refresh_uploaded_image_data(self):
         logger.info("\tRefreshing Meural image data")
         url = f"{URL_BASE}/user/items?count=500"
@@ -108,6 +113,7 @@ class MeuralAPI:
             self.uploaded_filenames_by_icloud_album_id[album_id].append(uploaded_image_data['name'])
         return
 
+    @Profiler.trace("meural.upload_image")
     def upload_image(self, image_filename):
         url = f"{URL_BASE}/items"
         files = {'image': open(f"{Env.IMAGE_DIR}/{image_filename}", 'rb')}
@@ -120,16 +126,19 @@ class MeuralAPI:
             raise
         return return_value
 
+    @Profiler.trace("meural.update_image_metadata")
     def update_image_metadata(self, image_id, metadata):
         url = f"{URL_BASE}/items/{image_id}"
         response = self.session.put(url, headers=self.headers, data=metadata, allow_redirects=True, timeout=15, verify=Env.VERIFY_SSL_CERTS)
         return response.content
 
+    @Profiler.trace("meural.delete_image")
     def delete_image(self, image_id):
         url = f"{URL_BASE}/items/{image_id}"
         response = self.session.delete(url, headers=self.headers, allow_redirects=True, timeout=15, verify=Env.VERIFY_SSL_CERTS)
         return
 
+    @Profiler.trace("meural.create_playlist")
     def create_playlist(self, name, description, orientation):
         url = f"{URL_BASE}/galleries"
         metadata = {
@@ -146,6 +155,7 @@ class MeuralAPI:
             raise
         return return_value
 
+    @Profiler.trace("meural.add_image_to_playlist")
     def add_image_to_playlist(self, image_id, playlist_id):
         url = f"{URL_BASE}/galleries/{playlist_id}/items/{image_id}"
         response = self.session.post(url, headers=self.headers, allow_redirects=True, timeout=15, verify=Env.VERIFY_SSL_CERTS)
@@ -1,48 +1,58 @@
-from configuration import Env, logger, halt_with_error
-import icloud
+from configuration import Env, logger
+from profiling import Profiler
+import meural
 import json
 import os
+import re
 import yaml
 
 class Metadata:
-    metadata_loc = f"{Env.CONFIG_DIR}/db.json"
-    db = {}
-
-    @classmethod
-    def initialize(cls):
+    def __init__(self, metadata_loc):
+        self.metadata_loc = metadata_loc
         # Now populate metadata db
-        cls.db = {}
-        if os.path.isfile(cls.metadata_loc):
-            with open(cls.metadata_loc, 'r') as json_file:
-                cls.db = json.load(json_file)
-
-    @classmethod
-    def save_db(cls):
-        with open(cls.metadata_loc, 'w') as json_file:
-            json.dump(cls.db, json_file, indent=4)
-
-    @classmethod
-    def mark_image_added_to_playlist(cls, icloud_album_id, meural_image_name):
-        if icloud_album_id not in cls.db:
-            cls.db[icloud_album_id] = {}
-        if meural_image_name not in cls.db[icloud_album_id]:
-            cls.db[icloud_album_id].append(meural_image_name)
+        self.db = {}
+        if os.path.isfile(self.metadata_loc):
+            with open(self.metadata_loc, 'r') as json_file:
+                self.db = json.load(json_file)
+
+    @Profiler.trace("metadata.save_db")
+    def save_db(self):
+        with open(self.metadata_loc, 'w') as json_file:
+            json.dump(self.db, json_file, indent=4)
+
+    def mark_image_added_to_playlist(self, icloud_album_id, meural_image_name):
+        if icloud_album_id not in self.db:
+            self.db[icloud_album_id] = []
+        if meural_image_name not in self.db[icloud_album_id]:
+            self.db[icloud_album_id].append(meural_image_name)
         else:
-            halt_with_error(f"Image {meural_image_name} already exists in db - somehow it was uploaded twice?")
-        cls.save_db()
+            raise RuntimeError(f"Image {meural_image_name} already exists in {self.metadata_loc} - somehow it was uploaded twice?")
+        self.save_db()
 
-    @classmethod
-    def mark_image_deleted_from_meural(cls, icloud_album_id, meural_image_name):
-        if meural_image_name in cls.db[icloud_album_id]:
-            cls.db[icloud_album_id].remove(meural_image_name)
+    def mark_image_deleted_from_meural(self, icloud_album_id, meural_image_name):
+        if meural_image_name in self.db.get(icloud_album_id, []):
+            self.db[icloud_album_id].remove(meural_image_name)
         else:
-            halt_with_error(f"Image {meural_image_name} does not exist in db - somehow it was deleted twice?")
-        cls.save_db()
+            raise RuntimeError(f"Image {meural_image_name} does not exist in {self.metadata_loc} - somehow it was deleted twice?")
+        self.save_db()
+
+class MeuralDestination:
+    def __init__(self, meural_account):
+        # Each Meural account has its own api session and metadata db, so no state is shared between accounts
+        self.name = meural_account.name
+        self.meural_account = meural_account
+        self.meural_api = meural.MeuralAPI(
+            username=meural_account.username,
+            password=meural_account.password
+        )
+        self.metadata = Metadata(meural_account.metadata_loc)
 
 class UserConfiguration:
     def __init__(self, config_location=f"{Env.CONFIG_DIR}/config.yaml"):
+        self.config_location = config_location
         self._raw_config = self.load_config(config_location)
-        self.sync_tasks = self.validate_and_return_tasks()
+        self.meural_accounts = self.validate_and_return_meural_accounts()
+        self.sync_tasks = [sync_task for meural_account in self.meural_accounts.values() for sync_task in meural_account.sync_tasks]
 
     def load_config(self, config_location):
         raw_config = None
@@ -53,19 +63,67 @@ class UserConfiguration:
             raise ValueError(f"Config file was not found. Please add one prior to launching this container.")
         return raw_config
 
-    def validate_and_return_tasks(self):
-        if "sync" not in self._raw_config:
-            raise ValueError(f'Config file is missing top-level "sync" key')
-        elif self._raw_config["sync"] is None:
+    def validate_and_return_meural_accounts(self):
+        if "sync" not in self._raw_config and "meural_accounts" not in self._raw_config:
+            raise ValueError(f'Config file is missing top-level "sync" or "meural_accounts" key')
+
+        meural_accounts = {}
+        # Top-level sync tasks belong to the account defined by the MEURAL_USERNAME/MEURAL_PASSWORD env vars
+        if "sync" in self._raw_config:
+            if not Env.MEURAL_USERNAME or not Env.MEURAL_PASSWORD:
+                raise ValueError(f'MEURAL_USERNAME and MEURAL_PASSWORD Environment variables must be set to use the top-level "sync" key')
+            meural_accounts[Env.DEFAULT_MEURAL_ACCOUNT_NAME] = UserConfiguration_MeuralAccount({
+                "name": Env.DEFAULT_MEURAL_ACCOUNT_NAME,
+                "username": Env.MEURAL_USERNAME,
+                "password": Env.MEURAL_PASSWORD,
+                "sync": self._raw_config["sync"]
+            })
+        for meural_account_dict in self._raw_config.get("meural_accounts") or []:
+            meural_account = UserConfiguration_MeuralAccount(meural_account_dict)
+            if meural_account.name in meural_accounts:
+                raise ValueError(f'Meural account name "{meural_account.name}" is used more than once')
+            meural_accounts[meural_account.name] = meural_account
+
+        if not any(meural_account.sync_tasks for meural_account in meural_accounts.values()):
             raise ValueError(f'There are no items to sync in the config. Ensure there is at least one item under "sync" prior to launching this container.')
-        return [UserConfiguration_SyncTask(sync_task_dict) for sync_task_dict in self._raw_config["sync"]]
+        return meural_accounts
+
+
+class UserConfiguration_MeuralAccount:
+    def __init__(self, meural_account_dict):
+        for key in ("name", "username", "password"):
+            if not meural_account_dict.get(key):
+                raise ValueError(f'A Meural account in the config is missing its "{key}" key')
+        self.name = meural_account_dict['name']
+        # The name is used in the account's metadata filename, so it must not be able to point outside the config directory
+        if not isinstance(self.name, str) or not re.fullmatch(r"[A-Za-z0-9_-]+", self.name):
+            raise ValueError(f'Meural account name "{self.name}" may only contain letters, numbers, "_" and "-"')
+        self.username = meural_account_dict['username']
+        self.password = meural_account_dict['password']
+        # The default account keeps using db.json so existing metadata carries over
+        db_filename = "db.json" if self.name == Env.DEFAULT_MEURAL_ACCOUNT_NAME else f"db_{self.name}.json"
+        self.metadata_loc = f"{Env.CONFIG_DIR}/{db_filename}"
+        self.sync_tasks = [UserConfiguration_SyncTask(sync_task_dict, self.name) for sync_task_dict in meural_account_dict.get('sync') or []]
+
+    def has_same_credentials(self, other):
+        return (self.username, self.password) == (other.username, other.password)
 
 
 class UserConfiguration_SyncTask:
-    def __init__(self, sync_task_dict):
+    def __init__(self, sync_task_dict, meural_account):
+        self._raw_sync_task = sync_task_dict
+        self.meural_account = meural_account
         self.icloud_album = sync_task_dict['icloud_album']
+        # The album id following the '#' is what iCloud is queried with
+        if not isinstance(self.icloud_album, str) or not self.icloud_album.partition('#')[2]:
+            raise ValueError(f'iCloud album "{self.icloud_album}" is not a valid shared album link - it must end with "#<album id>"')
         self.meural_playlists = [UserConfiguration_SyncTask_MeuralPlaylist(data) for data in sync_task_dict['meural_playlists']]
 
+    def __eq__(self, other):
+        if not isinstance(other, UserConfiguration_SyncTask):
+            return NotImplemented
+        return (self.meural_account, self._raw_sync_task) == (other.meural_account, other._raw_sync_task)
+
 class UserConfiguration_SyncTask_MeuralPlaylist:
     def __init__(self, meural_playlist_dict):
         self.name = meural_playlist_dict['name']
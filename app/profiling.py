@@ -0,0 +1,155 @@
+from configuration import Env, logger
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+import cProfile
+import functools
+import json
+import os
+import threading
+import time
+import tracemalloc
+
+class Profiler:
+    enabled = Env.PROFILING
+    output_dir = Env.PROFILING_DIR
+    max_cycles = Env.PROFILING_MAX_CYCLES
+
+    # Populated while a cycle is running, and written out by cycle()
+    _cycle_name = None
+    _spans = []
+    _thread_state = threading.local()
+
+    @classmethod
+    @contextmanager
+    def cycle(cls, name):
+        """Profiles everything that happens within the block, writing the results to the profiling directory once it exits"""
+        if not cls.enabled:
+            yield
+            return
+
+        cls._cycle_name = name
+        cls._spans = []
+        profile = cProfile.Profile()
+        tracemalloc.start()
+        profile.enable()
+        try:
+            with cls._span(name):
+                yield
+        finally:
+            profile.disable()
+            spans = cls._spans
+            cls._cycle_name = None
+            cls._spans = []
+            # Profiling is only for diagnostics - failing to save results must never interrupt a sync, or hide an exception it raised
+            try:
+                memory_snapshot = tracemalloc.take_snapshot()
+                _, peak_memory = tracemalloc.get_traced_memory()
+                cls._write_results(name, spans, profile, memory_snapshot, peak_memory)
+            except Exception as e:
+                logger.error(f"Failed to write profiling results for {name}: {e}")
+            finally:
+                tracemalloc.stop()
+            try:
+                cls._remove_old_results()
+            except Exception as e:
+                logger.error(f"Failed to remove old profiling results: {e}")
+
+    @classmethod
+    def span(cls, name):
+        """Times the block as a named span of the currently running cycle"""
+        if not cls.enabled:
+            return nullcontext()
+        return cls._span(name)
+
+    @classmethod
+    def trace(cls, name):
+        """Decorator version of span(). When profiling is disabled the function is returned unwrapped."""
+        def decorator(func):
+            if not cls.enabled:
+                return func
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with cls._span(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    @classmethod
+    @contextmanager
+    def _span(cls, name):
+        if cls._cycle_name is None:
+            yield
+            return
+
+        stack = getattr(cls._thread_state, "stack", None)
+        if stack is None:
+            stack = cls._thread_state.stack = []
+        stack.append(name)
+        start_ns = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            duration_ns = time.perf_counter_ns() - start_ns
+            cls._spans.append({
+                "stack": tuple(stack),
+                "start_ns": start_ns,
+                "duration_ns": duration_ns,
+                "thread_id": threading.get_ident()
+            })
+            stack.pop()
+
+    @classmethod
+    def _write_results(cls, name, spans, profile, memory_snapshot, peak_memory):
+        os.makedirs(cls.output_dir, exist_ok=True)
+        base_path = os.path.join(cls.output_dir, f"{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}_{name}")
+
+        # Chrome trace format, viewable in chrome://tracing or https://ui.perfetto.dev
+        with open(f"{base_path}.trace.json", 'w') as trace_file:
+            json.dump({
+                "traceEvents": [{
+                    "name": span["stack"][-1],
+                    "ph": "X",
+                    "ts": span["start_ns"] / 1000,
+                    "dur": span["duration_ns"] / 1000,
+                    "pid": os.getpid(),
+                    "tid": span["thread_id"]
+                } for span in spans]
+            }, trace_file)
+
+        # Folded stacks, usable with flamegraph.pl or speedscope. Values are self time in microseconds.
+        self_time_by_stack = {}
+        for span in spans:
+            self_time_by_stack[span["stack"]] = self_time_by_stack.get(span["stack"], 0) + span["duration_ns"]
+            if len(span["stack"]) > 1:
+                parent = span["stack"][:-1]
+                self_time_by_stack[parent] = self_time_by_stack.get(parent, 0) - span["duration_ns"]
+        with open(f"{base_path}.folded", 'w') as folded_file:
+            for stack, self_time_ns in self_time_by_stack.items():
+                folded_file.write(f"{';'.join(stack)} {max(0, self_time_ns // 1000)}\n")
+
+        # Raw cProfile stats, loadable with pstats or snakeviz
+        profile.dump_stats(f"{base_path}.prof")
+
+        # Top allocations still held at the end of the cycle
+        with open(f"{base_path}.memory.txt", 'w') as memory_file:
+            memory_file.write(f"Peak traced memory: {peak_memory / 1024:.1f} KiB\n\n")
+            for statistic in memory_snapshot.statistics('lineno')[:25]:
+                memory_file.write(f"{statistic}\n")
+
+        logger.info(f"Profiling results for {name} written to {base_path}.*")
+
+    @classmethod
+    def _remove_old_results(cls):
+        # A limit of 0 or less keeps results from every cycle
+        if cls.max_cycles <= 0:
+            return
+        # Every file of a cycle shares the same timestamped prefix, so sorting the prefixes orders cycles oldest first
+        filenames_by_cycle = {}
+        for filename in os.listdir(cls.output_dir):
+            filenames_by_cycle.setdefault(filename.split('.', 1)[0], []).append(filename)
+        cycles = sorted(filenames_by_cycle)
+        for cycle in cycles[:max(0, len(cycles) - cls.max_cycles)]:
+            for filename in filenames_by_cycle[cycle]:
+                os.remove(os.path.join(cls.output_dir, filename))
+            logger.debug(f"\tRemoved profiling results for {cycle}")